@@ -1,16 +1,115 @@
+import io
+import itertools
+import logging
+import math
 import os
-import re
-import tempfile
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import BinaryIO, List, Dict, Optional, Tuple, Union
 
 import boto3
+import boto3.s3.transfer
 import botocore
+import numpy as np
 import torch
+import torch.nn.functional as F
+import torchvision
 from label_studio_ml.model import LabelStudioMLBase
+from PIL import Image, ImageOps
 
-# Matches the S3 filepath format given by Label Studio
-FILEPATH_REGEX = re.compile(r"^s3://([^/]+)/(.+)$")
+try:
+    from s3transfer.crt import (
+        BotocoreCRTCredentialsWrapper,
+        BotocoreCRTRequestSerializer,
+        CRTTransferManager,
+        create_s3_crt_client,
+    )
+except ImportError:
+    # awscrt isn't installed, fall back to the standard transfer manager
+    CRTTransferManager = None
+
+# Prefix of the S3 filepath format given by Label Studio: s3://{bucket}/{filename}
+S3_PREFIX = "s3://"
+
+# EXIF orientation tag, 1 means the image is stored upright
+EXIF_ORIENTATION = 0x0112
+
+
+class ImageBuffer(io.RawIOBase):
+    """
+    An in-memory binary stream, like io.BytesIO, that keeps its allocated capacity when it's reset.
+
+    io.BytesIO shrinks its storage on truncate(), so reusing one for downloads would re-grow it from nothing every
+    time. This keeps the largest size written so far allocated and only tracks how much of it is in use.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._data = bytearray()
+        self._size = 0  # Bytes in use, `_data` can be larger
+        self._pos = 0
+
+    def reset(self):
+        """
+        Empty the buffer without releasing its memory
+        """
+        self._size = 0
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        if pos < 0:
+            raise ValueError(f"negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def write(self, b):
+        with memoryview(b) as view:
+            data = view.cast("B")
+            end = self._pos + len(data)
+            if self._pos > len(self._data):
+                # Writing past the end, fill the gap like a file would
+                self._data.extend(bytes(self._pos - len(self._data)))
+            # Overwrites existing capacity in place, only growing the bytearray when writing past its end
+            self._data[self._pos : end] = data
+        self._size = max(self._size, end)
+        self._pos = end
+        return len(data)
+
+    def readinto(self, b):
+        n = max(0, min(len(b), self._size - self._pos))
+        with memoryview(self._data) as view:
+            b[:n] = view[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def getbuffer(self) -> memoryview:
+        """
+        A view of the buffer's contents, it must be released before the buffer is written to again
+        """
+        return memoryview(self._data)[: self._size]
 
 
 class Yolov5Model(LabelStudioMLBase):
@@ -36,24 +135,138 @@ class Yolov5Model(LabelStudioMLBase):
         secret = os.environ["CLOUD_STORAGE_SECRET"]
         model_path = os.environ["MODEL_PATH"]
 
-        self.confidence_threshold = float(os.getenv("CONFIDENCE_THRESHOLD", 0.0))
+        # Defaults to AutoShape's own default so behavior is unchanged when this isn't set
+        self.confidence_threshold = float(os.getenv("CONFIDENCE_THRESHOLD", 0.25))
+        # Maximum number of images passed to the model in a single forward pass, and the inference size
+        self.max_batch = int(os.getenv("MAX_BATCH", 16))
+        self.image_size = int(os.getenv("IMAGE_SIZE", 640))
+        # Number of images downloaded concurrently when not using CRT, which schedules its own transfers.
+        # predict.py also uses this as its number of download threads.
+        self.download_workers = int(os.getenv("DOWNLOAD_WORKERS", 8))
         yolov5_path = os.getenv("YOLOV5_PATH", ".")
 
+        # Exported weights (e.g. `.engine` or `.onnx`) are dispatched to the matching backend by YOLOv5's DetectMultiBackend
         self.model = torch.hub.load(yolov5_path, "custom", model_path, source="local")
         self.model_name = Path(model_path).stem
+        self.model.eval()
+        self.use_cuda = torch.cuda.is_available()
+        if self.use_cuda and self.model.pt:
+            # Run PyTorch weights in FP16 on GPU, exported models already have their precision baked in
+            self.model = self.model.cuda().half()
+            # Tells DetectMultiBackend to cast its inputs to match
+            self.model.model.fp16 = True
+        # Filter detections in YOLOv5's NMS, which runs on the model's device.
+        # The AutoShape default confidence of 0.25 would otherwise silently override lower thresholds.
+        self.model.conf = self.confidence_threshold
+        self.model.iou = 0.45
+        # Maximum detections kept per image, also AutoShape's default
+        self.model.max_det = int(os.getenv("MAX_DET", 1000))
+        if self.model.pt and os.getenv("TORCHSCRIPT", "false").lower() == "true":
+            self._trace_model()
+        # Optionally decode and letterbox images on the GPU instead of in AutoShape's CPU preprocessing
+        self.gpu_preprocess = (
+            self.use_cuda and os.getenv("GPU_PREPROCESS", "false").lower() == "true"
+        )
+        if self.gpu_preprocess:
+            # YOLOv5 isn't an installable package, so use NMS from the same module AutoShape was loaded from
+            self._non_max_suppression = sys.modules[
+                type(self.model).__module__
+            ].non_max_suppression
+        # Run a dummy inference so one-time setup (CUDA kernels, TensorRT context) doesn't slow down the first request.
+        # This is a no-op on CPU.
+        self.model.model.warmup(imgsz=(1, 3, self.image_size, self.image_size))
         self.bucket = os.getenv("CLOUD_STORAGE_BUCKET")
 
+        # Images are downloaded into a fixed pool of reusable buffers, which also bounds memory use
+        self.buffer_pool = queue.Queue()
+        for _ in range(self.max_batch):
+            self.buffer_pool.put(ImageBuffer())
+        self.buffer_pool_lock = threading.Lock()
+
         session = boto3.session.Session()
         self.client = session.client(
             "s3",
             config=botocore.config.Config(
-                s3={"addressing_style": "virtual"}
-            ),  # Configures to use subdomain/virtual calling format.
+                # Configures to use subdomain/virtual calling format.
+                s3={"addressing_style": "virtual", "use_accelerate_endpoint": False},
+                # Keep enough warm connections around for concurrent downloads so they don't each pay for a new TLS handshake.
+                # The CRT client does its own networking, so these only apply when downloads fall back to this client.
+                max_pool_connections=32,
+                tcp_keepalive=True,
+                retries={"mode": "adaptive", "max_attempts": 5},
+            ),
             region_name=region,
             endpoint_url=f"https://{region}.{domain}",
             aws_access_key_id=key,
             aws_secret_access_key=secret,
         )
+        # Without CRT, larger objects are downloaded as parallel ranged GETs. CRT only shares the part size.
+        self.transfer_config = boto3.s3.transfer.TransferConfig(
+            max_concurrency=10,
+            multipart_threshold=8 * 1024 * 1024,
+            multipart_chunksize=8 * 1024 * 1024,
+            use_threads=True,
+        )
+
+        # Prefer the AWS CRT transfer manager when available, its native networking is considerably faster.
+        # Requests are still serialized by botocore so the endpoint and addressing style above are respected,
+        # but connection pooling and retries are handled by the CRT client itself.
+        self.transfer_manager = None
+        self.download_executor = None
+        if CRTTransferManager is not None:
+            credentials = botocore.credentials.Credentials(key, secret)
+            self.transfer_manager = CRTTransferManager(
+                create_s3_crt_client(
+                    region,
+                    crt_credentials_provider=BotocoreCRTCredentialsWrapper(
+                        credentials
+                    ).to_crt_credentials_provider(),
+                    part_size=self.transfer_config.multipart_chunksize,
+                ),
+                BotocoreCRTRequestSerializer(
+                    session._session,
+                    client_kwargs={
+                        "config": self.client.meta.config,
+                        "region_name": region,
+                        "endpoint_url": f"https://{region}.{domain}",
+                    },
+                ),
+            )
+        else:
+            # Shared between calls so concurrent callers don't each spin up their own threads
+            self.download_executor = ThreadPoolExecutor(
+                max_workers=self.download_workers
+            )
+
+    def _trace_model(self):
+        """
+        Replace the eager PyTorch model with a frozen and optimized TorchScript trace, falling back to eager if tracing fails.
+
+        The trace is specialized to a single input size, so inputs are letterboxed to a fixed `image_size` square afterwards.
+        """
+        backend = self.model.model  # DetectMultiBackend
+        dummy = torch.zeros(
+            1,
+            3,
+            self.image_size,
+            self.image_size,
+            device=backend.device,
+            dtype=torch.half if backend.fp16 else torch.float,
+        )
+        try:
+            with torch.no_grad():
+                traced = torch.jit.trace(backend.model, dummy, strict=False)
+                traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+                # The first few calls are slow while TorchScript profiles and specializes the graph
+                for _ in range(3):
+                    traced(dummy)
+        except Exception:
+            logging.exception("TorchScript tracing failed, using the eager model")
+            return
+
+        backend.model = traced
+        # AutoShape only letterboxes to the exact inference size for non-PyTorch backends
+        self.model.pt = False
 
     def predict(
         self, tasks: List[Dict], context: Optional[Dict] = None, **kwargs
@@ -65,60 +278,261 @@ class Yolov5Model(LabelStudioMLBase):
         :return predictions: [Predictions array in JSON format](https://labelstud.io/guide/export.html#Raw-JSON-format-of-completed-tasks)
         """
         predictions = []
-        with tempfile.NamedTemporaryFile() as fp:
-            for task in tasks:
-                # Prepare to download the image
-                if task["storage_filename"]:
-                    bucket = self.bucket
-                    filename = task["storage_filename"]
-                else:
-                    cloud_storage_path = task["data"]["image"]
-                    (bucket, filename) = FILEPATH_REGEX.match(
-                        cloud_storage_path
-                    ).groups()
-
-                # Download the image and run the model on it
-                self.client.download_fileobj(bucket, filename, fp)
-                model_results = self.model(fp.name)
-
-                # Get image dimensions from the tensor; this is needed for the bounding box conversions below
-                height = model_results.ims[0].shape[0]
-                width = model_results.ims[0].shape[1]
-
-                # Iterate through the results returned by the model and format each one for Label Studio
-                results = []
-                for result in model_results.pandas().xyxy[0].to_dict(orient="records"):
-                    if result["confidence"] > self.confidence_threshold:
-                        results.append(
-                            {
-                                # from_name and to_name come from the Label Studio "Labeling Interface" names; it is critical they match the Label Studio values
-                                "from_name": "label",
-                                "to_name": "image",
-                                "type": "rectanglelabels",  # should match the "to" type in the "Labeling Interface"
-                                "value": {
-                                    "rectanglelabels": [
-                                        result["name"]
-                                    ],  # Currently copying from the result name value but this can be anything
-                                    # Label Studio requires bounding box dimensions to be expressed as percentages of the image
-                                    "x": result["xmin"] / width * 100.0,
-                                    "y": result["ymin"] / height * 100.0,
-                                    "width": (result["xmax"] - result["xmin"])
-                                    / width
-                                    * 100.0,
-                                    "height": (result["ymax"] - result["ymin"])
-                                    / height
-                                    * 100.0,
-                                },
-                                "score": result["confidence"],
-                            }
-                        )
-
-                predictions.append(
-                    {"result": results, "model_version": self.model_name}
+        tasks = iter(tasks)
+        # Chunk the tasks so that at most `max_batch` images are held in memory and run through the model at once
+        while batch := list(itertools.islice(tasks, self.max_batch)):
+            predictions.extend(self.predict_images(self.load_images(batch)))
+
+        return predictions
+
+    def load_images(self, tasks: List[Dict]) -> List[Union[Image.Image, torch.Tensor]]:
+        """
+        Download and decode the images for tasks, concurrently and straight into memory
+        :param tasks: Label Studio tasks, at most `max_batch` of them
+        :return images: one image per task, in the same order as the tasks. These are uint8 CHW tensors on the GPU
+            if `gpu_preprocess` is enabled, otherwise PIL images.
+        """
+        # Take every buffer needed at once so concurrent callers can't each end up holding part of the pool
+        with self.buffer_pool_lock:
+            buffers = [self.buffer_pool.get() for _ in tasks]
+
+        try:
+            for buf in buffers:
+                buf.reset()
+            self._download_images(
+                [self._get_image_location(task) for task in tasks], buffers
+            )
+
+            images = [self._decode_image(buf) for buf in buffers]
+        finally:
+            for buf in buffers:
+                self.buffer_pool.put(buf)
+
+        return images
+
+    def _decode_image(self, buf: ImageBuffer) -> Union[Image.Image, torch.Tensor]:
+        """
+        Decode a downloaded image, straight onto the GPU if `gpu_preprocess` is enabled
+        :param buf: buffer containing the encoded image
+        :return image: a uint8 CHW tensor on the GPU if `gpu_preprocess` is enabled, otherwise a PIL image
+        """
+        buf.seek(0)
+        image = Image.open(buf)  # Only reads the header until the image is loaded
+
+        # nvJPEG can't apply EXIF rotations, so those images are left to PIL
+        if (
+            self.gpu_preprocess
+            and image.format in ("JPEG", "MPO")
+            and image.getexif().get(EXIF_ORIENTATION, 1) == 1
+        ):
+            # Copy the bytes out, a tensor sharing the buffer's memory would stop it from being reused
+            with buf.getbuffer() as view:
+                data = torch.frombuffer(bytearray(view), dtype=torch.uint8)
+            try:
+                return torchvision.io.decode_jpeg(
+                    data,
+                    mode=torchvision.io.ImageReadMode.RGB,
+                    device=self.model.model.device,
+                )
+            except RuntimeError:
+                # Unsupported by nvJPEG (e.g. CMYK), fall back to PIL
+                logging.debug(
+                    "GPU JPEG decoding failed, decoding on CPU", exc_info=True
+                )
+
+        image.load()  # Decode now, PIL is otherwise lazy and the buffer is about to be reused
+        # Apply any EXIF rotation up front so the image size matches what the model sees
+        ImageOps.exif_transpose(image, in_place=True)
+        if self.gpu_preprocess:
+            # Upload as uint8 from pinned memory, a quarter of the bytes of a float32 upload
+            return (
+                torch.from_numpy(np.array(image.convert("RGB")))
+                .permute(2, 0, 1)
+                .pin_memory()
+                .to(self.model.model.device, non_blocking=True)
+            )
+        return image
+
+    def predict_images(
+        self, images: List[Union[Image.Image, torch.Tensor]]
+    ) -> List[Dict]:
+        """
+        Run the model on a batch of images in a single forward pass
+        :param images: images returned by `load_images`, at most `max_batch` of them
+        :return predictions: one prediction per image, in the same order as the images
+        """
+        if self.gpu_preprocess:
+            detections = self._predict_tensors(images)
+        else:
+            # YOLOv5 batches a list of images into a single forward pass
+            with torch.inference_mode(), torch.cuda.amp.autocast(enabled=self.use_cuda):
+                detections = self.model(images, size=self.image_size).xyxyn
+
+        predictions = []
+        # NMS has already filtered detections on the model's device, so move the survivors for the whole batch to
+        # the CPU in a single transfer rather than once per image
+        counts = [len(det) for det in detections]
+        batch_det = torch.cat(detections).cpu().numpy()
+        batch_det = np.split(batch_det, np.cumsum(counts)[:-1])
+
+        names = self.model.names
+        for det in batch_det:
+            # Columns are xmin, ymin, xmax, ymax, confidence, class with coordinates normalized to [0, 1].
+            # Label Studio requires bounding box dimensions to be expressed as percentages of the image
+            boxes = det[:, :4] * 100.0
+            xs = boxes[:, 0]
+            ys = boxes[:, 1]
+            ws = boxes[:, 2] - boxes[:, 0]
+            hs = boxes[:, 3] - boxes[:, 1]
+
+            # Format each result for Label Studio
+            results = [
+                {
+                    # from_name and to_name come from the Label Studio "Labeling Interface" names; it is critical they match the Label Studio values
+                    "from_name": "label",
+                    "to_name": "image",
+                    "type": "rectanglelabels",  # should match the "to" type in the "Labeling Interface"
+                    "value": {
+                        # Currently copying from the model's class name but this can be anything
+                        "rectanglelabels": [names[int(cls)]],
+                        "x": x,
+                        "y": y,
+                        "width": w,
+                        "height": h,
+                    },
+                    "score": confidence,
+                }
+                # tolist() converts to native floats in one go so the results are JSON serializable
+                for x, y, w, h, confidence, cls in zip(
+                    xs.tolist(),
+                    ys.tolist(),
+                    ws.tolist(),
+                    hs.tolist(),
+                    det[:, 4].tolist(),
+                    det[:, 5].tolist(),
                 )
+            ]
+
+            predictions.append({"result": results, "model_version": self.model_name})
 
         return predictions
 
+    def _predict_tensors(self, images: List[torch.Tensor]) -> List[torch.Tensor]:
+        """
+        Letterbox, run the model on, and apply NMS to images that are already on the GPU, bypassing AutoShape
+        :param images: uint8 CHW tensors on the model's device
+        :return detections: one (xmin, ymin, xmax, ymax, confidence, class) tensor per image, with coordinates
+            normalized to [0, 1] like YOLOv5's `xyxyn`
+        """
+        backend = self.model.model  # DetectMultiBackend
+        dtype = torch.half if backend.fp16 else torch.float
+
+        # Scale each image so its longest side is `image_size`
+        ratios = [self.image_size / max(image.shape[1:]) for image in images]
+        shapes = [
+            (round(image.shape[1] * r), round(image.shape[2] * r))
+            for image, r in zip(images, ratios)
+        ]
+        if self.model.pt:
+            # Like AutoShape, pad to the smallest multiple of the stride that fits the whole batch
+            stride = int(self.model.stride)
+            batch_h, batch_w = (
+                math.ceil(max(dim) / stride) * stride for dim in zip(*shapes)
+            )
+        else:
+            # Exported and traced models expect a fixed square input
+            batch_h = batch_w = self.image_size
+
+        with torch.inference_mode():
+            # Letterbox into the batch tensor, centered and padded with grey like YOLOv5's letterbox
+            batch = torch.full(
+                (len(images), 3, batch_h, batch_w),
+                114,
+                dtype=dtype,
+                device=backend.device,
+            )
+            pads = []
+            for i, (image, (h, w)) in enumerate(zip(images, shapes)):
+                top = round((batch_h - h) / 2 - 0.1)
+                left = round((batch_w - w) / 2 - 0.1)
+                batch[i, :, top : top + h, left : left + w] = F.interpolate(
+                    image[None].to(dtype),
+                    size=(h, w),
+                    mode="bilinear",
+                    align_corners=False,
+                )[0]
+                pads.append((left, top))
+            batch /= 255
+
+            with torch.cuda.amp.autocast():
+                pred = backend(batch)
+            detections = self._non_max_suppression(
+                pred,
+                self.model.conf,
+                self.model.iou,
+                max_det=self.model.max_det,
+            )
+
+            # Undo the letterbox padding and normalize by the resized image's dimensions,
+            # which is the same as normalizing by the original image's dimensions
+            for det, (h, w), (left, top) in zip(detections, shapes, pads):
+                det[:, [0, 2]] = ((det[:, [0, 2]] - left) / w).clamp(0, 1)
+                det[:, [1, 3]] = ((det[:, [1, 3]] - top) / h).clamp(0, 1)
+
+        return detections
+
+    def _download_images(
+        self, locations: List[Tuple[str, str]], buffers: List[BinaryIO]
+    ) -> None:
+        """
+        Download images concurrently
+        :param locations: (bucket, filename) pairs to download
+        :param buffers: writable file-like objects to download each location into
+        """
+        if self.transfer_manager is not None:
+            # The CRT transfer manager is asynchronous, so just queue everything up
+            futures = [
+                self.transfer_manager.download(bucket, filename, buf)
+                for (bucket, filename), buf in zip(locations, buffers)
+            ]
+        else:
+            futures = [
+                self.download_executor.submit(
+                    self.client.download_fileobj,
+                    bucket,
+                    filename,
+                    buf,
+                    Config=self.transfer_config,
+                )
+                for (bucket, filename), buf in zip(locations, buffers)
+            ]
+
+        # Wait for every download to finish, even after one fails, so no buffer is still being written to once this
+        # returns and it goes back to the pool. Then re-raise the first failure.
+        error = None
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def _get_image_location(self, task: Dict) -> Tuple[str, str]:
+        """
+        Get the cloud storage location of a task's image
+        :param task: Label Studio task
+        :return (bucket, filename): where the image can be downloaded from
+        """
+        if task["storage_filename"]:
+            return (self.bucket, task["storage_filename"])
+
+        cloud_storage_path = task["data"]["image"]
+        assert cloud_storage_path.startswith(S3_PREFIX), cloud_storage_path
+        bucket, _, filename = cloud_storage_path[len(S3_PREFIX) :].partition("/")
+        return (bucket, filename)
+
     def fit(self, event, data, **kwargs):
         """
         This method is called each time an annotation is created or updated
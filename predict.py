@@ -1,15 +1,30 @@
 import argparse
 import logging
+import math
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from dotenv import load_dotenv
-from progress.bar import Bar
 from requests.adapters import HTTPAdapter
+from tqdm import tqdm
 from urllib3.util import Retry
 
 from model import Yolov5Model
 
+# Pipeline tuning: the number of post threads and how many items can be queued between stages.
+# The number of download threads comes from the model's DOWNLOAD_WORKERS setting.
+POST_WORKERS = 4
+QUEUE_SIZE = 32
+# Connections kept open to Label Studio
+POOL_SIZE = 32
+
+# Sentinel telling a pipeline worker to exit
+_DONE = object()
+
 
 def create_predictions(base_url, access_token, project_id, view_id, dry_run=False):
     """
@@ -41,7 +56,12 @@ def create_predictions(base_url, access_token, project_id, view_id, dry_run=Fals
     # Create the session
     session = requests.Session()
     session.headers.update({"Authorization": f"Token {access_token}"})
-    session.mount("https://", HTTPAdapter(max_retries=retries))
+    # Size the connection pool so every pipeline worker can keep its connection alive instead of reconnecting
+    adapter = HTTPAdapter(
+        max_retries=retries, pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
 
     # Setup parameters
     page_size = 50
@@ -58,71 +78,181 @@ def create_predictions(base_url, access_token, project_id, view_id, dry_run=Fals
     total_task_count = r["total"]
     params["page_size"] = page_size
 
+    def fetch_page(page):
+        """
+        Fetch a page of `page_size` tasks to process
+        """
+        resp = session.get(tasks_url, params=params | {"page": page}, timeout=10)
+        if resp.status_code == 404:
+            # The page no longer exists, e.g. tasks were deleted since the total was fetched
+            return []
+        resp.raise_for_status()
+        return resp.json()["tasks"]
+
+    # How long, in seconds, the inference worker waits for new images to fill up a batch before running it anyway
+    max_wait = float(os.getenv("MAX_WAIT_MS", 50)) / 1000
+
+    # Work is pipelined through three stages so downloads, inference, and prediction creation all overlap:
+    # download workers -> inference worker (owns the model) -> post workers
+    download_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    inference_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    post_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    # Set if processing has to be abandoned, queued work is then drained without being processed
+    stop = threading.Event()
+
+    # tqdm.update isn't thread safe (only its refresh is locked), and every stage reports progress
+    bar_lock = threading.Lock()
+
+    def update_progress(count=1):
+        with bar_lock:
+            bar.update(count)
+
+    def download_worker():
+        while (task := download_queue.get()) is not _DONE:
+            try:
+                if not stop.is_set():
+                    [image] = model.load_images([task])
+                    inference_queue.put((task, image))
+                else:
+                    update_progress()
+            except Exception:
+                logging.exception(f"Error downloading image for task {task['id']}")
+                update_progress()
+            finally:
+                download_queue.task_done()
+        download_queue.task_done()
+
+    def inference_worker():
+        while (item := inference_queue.get()) is not _DONE:
+            # Run the batch once it's full or once `max_wait` has passed since its first image was taken, whichever
+            # comes first. Images that are already queued are always taken, only waiting for new ones is bounded,
+            # so a backlog is run in full batches while a trickle of images isn't stalled.
+            batch = [item]
+            deadline = time.monotonic() + max_wait
+            while len(batch) < model.max_batch:
+                try:
+                    item = inference_queue.get_nowait()
+                except queue.Empty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = inference_queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if item is _DONE:
+                    # Put it back so the outer loop exits after this batch
+                    inference_queue.task_done()
+                    inference_queue.put(_DONE)
+                    break
+                batch.append(item)
+
+            tasks = [task for (task, _) in batch]
+            try:
+                if not stop.is_set():
+                    logging.info(
+                        f"Running inference for tasks {[task['id'] for task in tasks]}"
+                    )
+                    predictions = model.predict_images([image for (_, image) in batch])
+                    for task, prediction in zip(tasks, predictions):
+                        post_queue.put((task, prediction))
+                else:
+                    update_progress(len(batch))
+            except Exception:
+                logging.exception(
+                    f"Error running model for tasks {[task['id'] for task in tasks]}"
+                )
+                update_progress(len(batch))
+            finally:
+                for _ in batch:
+                    inference_queue.task_done()
+        inference_queue.task_done()
+
+    def post_worker():
+        while (item := post_queue.get()) is not _DONE:
+            task, prediction = item
+            task_id = task["id"]
+            # Create the prediction in Label Studio
+            try:
+                if not dry_run and not stop.is_set():
+                    logging.info(f"Creating prediction for task {task_id}")
+                    logging.debug(prediction)
+                    resp = session.post(
+                        predict_url,
+                        json=(prediction | {"task": task_id, "project": project_id}),
+                        timeout=10,
+                    )
+                    resp.raise_for_status()
+            except Exception:
+                # Catch everything, an exception escaping would kill the worker and stall the pipeline
+                logging.exception(f"Error creating prediction for task {task_id}")
+            finally:
+                update_progress()
+                post_queue.task_done()
+        post_queue.task_done()
+
+    stages = [
+        (download_queue, download_worker, model.download_workers),
+        (inference_queue, inference_worker, 1),
+        (post_queue, post_worker, POST_WORKERS),
+    ]
+
     # Create a progress bar for the total task count and start processing.
     # Because the task count might change, this is really just a best effort estimate.
     # Technically this could probably be updated/recreated on each new page, that might be a decent improvement.
     logging.info("Processing tasks")
-    with Bar(
-        "Predicting",
-        max=total_task_count,
-        suffix="%(index)d/%(max)d - %(percent).1f%% - Elapsed: %(elapsed_td)s - ETA: %(eta_td)s",
-    ) as bar:
-        # Run until there are no more tasks
-        while True:
-            try:
-                # Fetch a batch of `page_size` tasks to process
-                resp = session.get(tasks_url, params=params, timeout=10)
-                resp.raise_for_status()
-                tasks = resp.json()["tasks"]
+    with tqdm(desc="Predicting", total=total_task_count) as bar:
+        workers = []
+        for stage_queue, target, count in stages:
+            # Daemon threads so an interrupt during shutdown can't leave the interpreter waiting on them forever
+            threads = [
+                threading.Thread(target=target, daemon=True) for _ in range(count)
+            ]
+            for thread in threads:
+                thread.start()
+            workers.append((stage_queue, threads))
 
-                if len(tasks) == 0:
-                    logging.info("Done")
-                    break
+        try:
+            # Pages are processed last to first. Views that only contain tasks without predictions shrink as
+            # predictions are created, which only shifts the pages after the current one, i.e. ones already processed.
+            # That keeps pagination stable for both kinds of views and means the next page can be fetched early.
+            page_count = math.ceil(total_task_count / page_size)
+            with ThreadPoolExecutor(max_workers=1) as page_executor:
+                if page_count:
+                    next_page = page_executor.submit(fetch_page, page_count)
+                for page in range(page_count, 0, -1):
+                    tasks = next_page.result()
+                    # Fetch the next page while this one is being processed
+                    if page > 1:
+                        next_page = page_executor.submit(fetch_page, page - 1)
+
+                    for task in tasks:
+                        task_id = task["id"]
 
-                # TODO: this should be fairly easy to parallelize with a basic executor, other than it would likely break the progress bar.
-                # I'm not sure how much time is spent on network calls vs running the model, so while multiple processes are a clear win
-                # it might also make sense to use multiple threads per process for maximum speedup, not that maximum speed is necessary.
-                # Shame python is kind of terrible for this kind of parallelism :/
-                for task in tasks:
-                    task_id = task["id"]
-                    logging.info(f"Running inference for task {task_id}")
-
-                    # TODO: instead of just looking at the prediction count, we might want to see if there are any predictions for this model instead.
-                    # Conversely we could require a view and just trust that every task needs to be processed
-                    if task["total_predictions"] == 0:
-                        # Run the model
-                        try:
-                            [prediction] = model.predict([task])
-                        except Exception:
-                            logging.exception(f"Error running model for task {task_id}")
-                            continue
-
-                        # Create the prediction in Label Studio
-                        if not dry_run:
-                            logging.info(f"Creating prediction for task {task_id}")
-                            logging.debug(prediction)
-                            try:
-                                resp = session.post(
-                                    predict_url,
-                                    json=(
-                                        prediction
-                                        | {"task": task_id, "project": project_id}
-                                    ),
-                                    timeout=10,
-                                )
-                                resp.raise_for_status()
-                            except requests.exceptions.HTTPError:
-                                logging.exception(
-                                    f"Error creating prediction for task {task_id}"
-                                )
-                    else:
-                        logging.info(f"Skipping task {task_id}, existing prediction(s)")
-
-                    # Update the progress bar
-                    bar.next()
-            except Exception as e:
-                logging.exception("Unexpected exception")
-                break
+                        # TODO: instead of just looking at the prediction count, we might want to see if there are any predictions for this model instead.
+                        # Conversely we could require a view and just trust that every task needs to be processed
+                        if task["total_predictions"] == 0:
+                            download_queue.put(task)
+                        else:
+                            logging.info(
+                                f"Skipping task {task_id}, existing prediction(s)"
+                            )
+                            update_progress()
+            logging.info("Done")
+        except Exception:
+            logging.exception("Unexpected exception")
+            stop.set()
+        except BaseException:
+            # e.g. Ctrl-C, abandon the queued work instead of finishing it
+            stop.set()
+            raise
+        finally:
+            # Shut the stages down in order, each one finishes its queued work first (or drains it if stopped)
+            for stage_queue, threads in workers:
+                for _ in threads:
+                    stage_queue.put(_DONE)
+                for thread in threads:
+                    thread.join()
 
 
 if __name__ == "__main__":